@@ -197,12 +197,12 @@ def do_data_split_mortality(args):
         del val_X, val_y, test_X, test_y
         assert train_X.shape == (21139,714) and train_y.shape == (21139,)
         # shuffle full data
-        inds = np.linspace(0,len(train_y)-1,len(train_y),dtype=int)
+        inds = np.arange(len(train_y))
         np.random.shuffle(inds)
         train_X = train_X[inds,:]
         train_y = train_y[inds]
-        pos_inds = np.linspace(0,len(train_y)-1,len(train_y),dtype=int)[train_y == 1]
-        neg_inds = (np.linspace(0,len(train_y)-1,len(train_y),dtype=int)[train_y == 0])[:len(pos_inds)]
+        pos_inds = np.flatnonzero(train_y == 1)
+        neg_inds = np.flatnonzero(train_y == 0)[:len(pos_inds)]
         #print(len(pos_inds), len(neg_inds))
         assert len(pos_inds) == len(neg_inds)
         inds = np.concatenate((pos_inds,neg_inds))
@@ -264,7 +264,7 @@ def do_data_split_mortality(args):
         print('Dividing training data into client partitions via K-means')
         kmeans = KMeans(n_clusters=args.n_clusters, max_iter=300, tol=0.0001, verbose=0, random_state=2303, copy_x=True, algorithm='auto')
         kmeans_res = kmeans.fit(train_X)
-        cur_clusters = np.linspace(0,args.n_clusters-1, args.n_clusters, dtype=int)
+        cur_clusters = np.arange(args.n_clusters)
         labels = copy(kmeans_res.labels_)
         for i in range(args.n_clusters):
             if len(cur_clusters) <= args.n_clients:
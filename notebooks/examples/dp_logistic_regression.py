@@ -5,7 +5,6 @@ Script for testing private PVI with logistic regression based on DP-SGD/suff.sta
 import argparse
 import logging
 import os
-import random
 import sys
 from warnings import warn
 
@@ -13,7 +12,6 @@ import matplotlib.pyplot as plt
 import numpy as np
 import torch
 import tqdm.auto as tqdm
-from sklearn.model_selection import KFold
 
 module_path = os.path.abspath(os.path.join("../.."))
 if module_path not in sys.path:
@@ -48,6 +46,54 @@ logging.basicConfig(
 )
 
 
+def _check_swor_sampling(args):
+    if args.sampling_frac_q is not None and args.batch_size is not None:
+        logger.info(f'Using user-level SWOR sampling with sampling frac {args.sampling_frac_q} and fixed user data of size {args.batch_size}. Full batch is used when user is sampled.)')
+    elif args.sampling_frac_q is not None:
+        logger.info(f'Using SWOR sampling with sampling frac {args.sampling_frac_q}')
+    elif args.batch_size is not None:
+        logger.info(f'Using SWOR sampling with batch size {args.batch_size}')
+    else:
+        raise ValueError("Need to set at least one of 'batch_size', 'sampling_frac_q'!")
+
+
+def _check_sequential_sampling(args):
+    if args.batch_size is not None and args.sampling_frac_q is not None:
+        raise ValueError("Exactly one of 'batch_size', 'sampling_frac_q' needs to be None")
+    elif args.batch_size is None:
+        logger.info(f'Using sequential data passes with local sampling frac {args.sampling_frac_q} (separate models for each batch)')
+    else:
+        logger.info(f'Using sequential data passes with batch size {args.batch_size} (separate models for each batch)')
+
+
+def _log_nondp_batches(args):
+    logger.info(f'Sampling {args.n_steps} batches per global update with batch size {args.batch_size}')
+
+
+def _log_nondp_epochs(args):
+    logger.info(f'Sampling {args.n_steps} epochs per global update with batch size {args.batch_size}')
+
+
+def _to_float16(arr, name):
+    """Cast array to float16 for storage, values outside float16 range become inf
+    """
+    if np.any(np.abs(arr[np.isfinite(arr)]) > np.finfo(np.float16).max):
+        logger.warning(f'{name} has values outside float16 range, these are stored as inf')
+    return arr.astype(np.float16)
+
+
+# allowed dp_modes, each mapped to a fun for checking sampling args
+DP_MODES = {
+    'dpsgd' : _check_swor_sampling,
+    'param_fixed' : _check_swor_sampling,
+    'lfa' : _check_sequential_sampling,
+    'local_pvi' : _check_sequential_sampling,
+    'param' : _check_sequential_sampling,
+    'nondp_batches' : _log_nondp_batches,
+    'nondp_epochs' : _log_nondp_epochs,
+}
+
+
 def main(args, rng_seed, dataset_folder):
     """
     Args: see argparser options
@@ -57,7 +103,7 @@ def main(args, rng_seed, dataset_folder):
     pbar = args.pbar
 
     # do some args checks
-    if args.dp_mode not in ['nondp_batches', 'nondp_epochs','dpsgd', 'param','param_fixed','server','lfa', 'local_pvi']:
+    if args.dp_mode not in DP_MODES:
         raise ValueError(f"Unknown dp_mode: {args.dp_mode}")
 
     if args.model not in ['pvi', 'bcm_split', 'bcm_same', 'global_vi']:
@@ -66,38 +112,11 @@ def main(args, rng_seed, dataset_folder):
     
     logger.info(f"Starting {args.model} run with data folder: {dataset_folder}, dp_mode: {args.dp_mode}")
 
-    if args.dp_mode in ['dpsgd','param_fixed']:#[seq','swor']:
-        if args.sampling_frac_q is not None and args.batch_size is not None:
-            logger.info(f'Using user-level SWOR sampling with sampling frac {args.sampling_frac_q} and fixed user data of size {args.batch_size}. Full batch is used when user is sampled.)')
-        
-        elif args.sampling_frac_q is not None:
-            logger.info(f'Using SWOR sampling with sampling frac {args.sampling_frac_q}')
-        elif args.batch_size is not None:
-            logger.info(f'Using SWOR sampling with batch size {args.batch_size}')
-        else:
-            raise ValueError("Need to set at least one of 'batch_size', 'sampling_frac_q'!")
-
-    elif args.dp_mode in ['lfa', 'local_pvi','param']:
-        if args.batch_size is not None and args.sampling_frac_q is not None:
-            raise ValueError("Exactly one of 'batch_size', 'sampling_frac_q' needs to be None")
-        elif args.batch_size is None:
-            logger.info(f'Using sequential data passes with local sampling frac {args.sampling_frac_q} (separate models for each batch)')
-        elif args.sampling_frac_q is None:
-            logger.info(f'Using sequential data passes with batch size {args.batch_size} (separate models for each batch)')
-    else:
-        if args.dp_mode in ['nondp_batches']:
-            logger.info(f'Sampling {args.n_steps} batches per global update with batch size {args.batch_size}')
-        elif args.dp_mode in ['nondp_epochs']: 
-            logger.info(f'Sampling {args.n_steps} epochs per global update with batch size {args.batch_size}')
-        else:
-            raise ValueError(f"Unknown dp_mode: {args.dp_mode}")
+    # check sampling args & log sampling type for the chosen dp_mode
+    DP_MODES[args.dp_mode](args)
 
     # fix random seeds
-    np.random.seed(rng_seed)
-    torch.random.manual_seed(rng_seed)
-    random.seed(rng_seed)
-    if torch.cuda.is_available() and torch.cuda.device_count() > 0:
-      torch.cuda.manual_seed(rng_seed)
+    seed_everything(rng_seed)
 
     data_args=None
     # additional flag for using balanced MIMIC-III 
@@ -110,8 +129,8 @@ def main(args, rng_seed, dataset_folder):
             )
     x_train, x_valid, y_train, y_valid = train_set['x'], valid_set['x'], train_set['y'], valid_set['y']
 
-    logger.info(f'Proportion of positive examples in each client: {np.array(prop_positive).round(2)}')
-    logger.info(f'Total number of examples in each client: {N}')
+    logger.info('Proportion of positive examples in each client: %s', [round(float(p), 2) for p in prop_positive])
+    logger.info('Total number of examples in each client: %s', N)
 
     # not optimising hyperparams
     model_hyperparameters = {
@@ -124,6 +143,16 @@ def main(args, rng_seed, dataset_folder):
 
     model = LogisticRegressionModel(hyperparameters=model_hyperparameters, config=model_config)
 
+    if args.jit:
+        # trace predictive logits once, fall back to eager mode if tracing fails
+        example_x = torch.zeros((2, x_train.shape[1]))
+        example_thetas = torch.zeros((model_config['num_predictive_samples'], x_train.shape[1]+1))
+        try:
+            model._predict_fn = torch.jit.trace(model._predict_fn, (example_x, example_thetas), check_trace=False)
+            logger.debug('Using traced predictive function')
+        except RuntimeError as e:
+            logger.warning(f'Tracing predictive function failed, using eager mode: {e}')
+
     # define multistep lr scheduler bounds
     if args.use_lr_scheduler and args.n_global_updates > 5:
         # reduce by 1/2 at the middle and again 2 global updates before end
@@ -169,14 +198,17 @@ def main(args, rng_seed, dataset_folder):
     }
 
     # prior params, use data dim+1 when assuming model adds extra bias dim
+    # create directly on the data device so clients never need to copy them
+    D = x_train.shape[1]
+    device = x_train.device
     prior_std_params = {
-        "loc"   : torch.zeros(x_train.shape[1]+1),
-        "scale" : torch.ones(x_train.shape[1]+1),
+        "loc"   : torch.zeros(D+1, device=device),
+        "scale" : torch.ones(D+1, device=device),
     }
     # these used as initial t-factor params, should match prior, dims as above
     init_nat_params = {
-        "np1" : torch.zeros(x_train.shape[1] + 1),
-        "np2" : torch.zeros(x_train.shape[1] + 1),
+        "np1" : torch.zeros(D+1, device=device),
+        "np2" : torch.zeros(D+1, device=device),
     }
 
     # Initialise clients, q and server
@@ -244,10 +276,9 @@ def main(args, rng_seed, dataset_folder):
     validation_res['acc'] = np.zeros((args.n_global_updates))
     validation_res['logl'] = np.zeros((args.n_global_updates))
     validation_res['posneg'] = []
-    client_train_res = {}
-    client_train_res['elbo'] = np.zeros((args.clients, args.n_global_updates, args.n_steps))
-    client_train_res['logl'] = np.zeros((args.clients, args.n_global_updates, args.n_steps))
-    client_train_res['kl'] = np.zeros((args.clients, args.n_global_updates, args.n_steps))
+    # single contiguous buffer for all client curves, dict entries are views into it
+    client_train_curves = np.zeros((3, args.clients, args.n_global_updates, args.n_steps), dtype=np.float32)
+    client_train_res = dict(zip(['elbo', 'logl', 'kl'], client_train_curves))
 
 
     ################### param tracking
@@ -260,12 +291,16 @@ def main(args, rng_seed, dataset_folder):
         logger.warning('tracking all parameter histories, this might be costly!')
         
         # note: after training get natural params
-        param_trace1 = np.zeros((args.n_global_updates+1, len(server.q._std_params['loc']))) 
-        param_trace2 = np.zeros((args.n_global_updates+1, len(server.q._std_params['scale'])))
-        param_trace1[0,:] = server.q._std_params['loc'].detach().numpy()
-        param_trace2[0,:] = server.q._std_params['scale'].detach().numpy()
+        # loc & scale traces in a single preallocated tensor, filled in place
+        param_trace = torch.zeros((args.n_global_updates+1, 2, len(server.q._std_params['loc'])))
+        param_trace[0,0].copy_(server.q._std_params['loc'].detach())
+        param_trace[0,1].copy_(server.q._std_params['scale'].detach())
 
     
+    # convert eval data to float tensors once, as_tensor avoids a copy when data are already float tensors
+    x_train, y_train = torch.as_tensor(x_train, dtype=torch.float32), torch.as_tensor(y_train, dtype=torch.float32)
+    x_valid, y_valid = torch.as_tensor(x_valid, dtype=torch.float32), torch.as_tensor(y_valid, dtype=torch.float32)
+
     i_global = 0
     logger.info('Starting model training')
     while not server.should_stop():
@@ -275,15 +310,17 @@ def main(args, rng_seed, dataset_folder):
 
         if args.model != 'global_vi' and args.n_step_dict is None:
             # get client training curves
+            compiled_log = server.get_compiled_log()
             for i_client in range(args.clients):
-                client_train_res['elbo'][i_client,i_global,:] = server.get_compiled_log()[f'client_{i_client}']['training_curves'][server.iterations-1]['elbo']
-                client_train_res['logl'][i_client,i_global,:] = server.get_compiled_log()[f'client_{i_client}']['training_curves'][server.iterations-1]['ll']
-                client_train_res['kl'][i_client,i_global,:] = server.get_compiled_log()[f'client_{i_client}']['training_curves'][server.iterations-1]['kl']
+                curves = compiled_log[f'client_{i_client}']['training_curves'][server.iterations-1]
+                client_train_curves[:,i_client,i_global,:] = (curves['elbo'], curves['ll'], curves['kl'])
             
         # get global train and validation acc & logl, assume to be tensors here
         #train_acc, train_logl = acc_and_ll(server, torch.tensor(x_train).float(), torch.tensor(y_train).float())
-        train_acc, train_logl, train_posneg = acc_and_ll(server, x_train, y_train)
-        valid_acc, valid_logl, valid_posneg = acc_and_ll(server, valid_set['x'], valid_set['y'])
+        # use the same predictive samples for both sets, no autograd needed for evaluation
+        with torch.inference_mode():
+            (train_acc, train_logl, train_posneg), (valid_acc, valid_logl, valid_posneg) = acc_and_ll_multi(
+                    server, [(x_train, y_train), (x_valid, y_valid)])
 
         train_res['acc'][i_global] = train_acc
         train_res['logl'][ i_global] = train_logl
@@ -296,46 +333,61 @@ def main(args, rng_seed, dataset_folder):
         if args.track_params:
 
             tmp = server.q._std_from_nat(server.q._nat_params)
-            param_trace1[i_global+1, :] = tmp['loc'].detach().numpy()
-            param_trace2[i_global+1, :] = tmp['scale'].detach().numpy()
+            param_trace[i_global+1,0].copy_(tmp['loc'].detach())
+            param_trace[i_global+1,1].copy_(tmp['scale'].detach())
         
         print(f'Train: accuracy {train_acc:.3f}, mean-loglik {train_logl:.3f}\n'
               f'Valid: accuracy {valid_acc:.3f}, mean-loglik {valid_logl:.3f}\n')
 
         i_global += 1
 
-    if args.track_client_norms and args.plot_tracked:
-        # separate script for lfa/dpsgd etc?
+    if args.track_params:
+        param_trace1, param_trace2 = param_trace.numpy()[:,0,:], param_trace.numpy()[:,1,:]
+
+    # compile possible tracked norms etc
+    tracked = {}
+    if args.track_client_norms:
         if args.dp_mode == 'dpsgd':
             if args.model == 'global_vi':
-                pre_dp_norms = np.zeros((1, args.n_global_updates * args.n_steps))
-                post_dp_norms = np.zeros((1, args.n_global_updates * args.n_steps))
-                pre_dp_norms[0,:] = server.pre_dp_norms
-                post_dp_norms[0,:] = server.post_dp_norms
+                pre_dp_norms = np.stack([server.pre_dp_norms], dtype=np.float32)
+                post_dp_norms = np.stack([server.post_dp_norms], dtype=np.float32)
             else:
-                pre_dp_norms = np.zeros((args.clients, args.n_global_updates * args.n_steps))
-                post_dp_norms = np.zeros((args.clients, args.n_global_updates * args.n_steps))
-                for i_client, client in enumerate(clients):
-                    pre_dp_norms[i_client,:] = client.pre_dp_norms
-                    post_dp_norms[i_client,:] = client.post_dp_norms
-            x1 = np.linspace(1,args.n_global_updates*args.n_steps, args.n_global_updates*args.n_steps)
-            x2 = np.linspace(1,args.n_global_updates*args.n_steps, args.n_global_updates*args.n_steps)
+                pre_dp_norms = np.stack([client.pre_dp_norms for client in clients], dtype=np.float32)
+                post_dp_norms = np.stack([client.post_dp_norms for client in clients], dtype=np.float32)
+        elif args.dp_mode in ['lfa']:
+            pre_dp_norms = np.stack([np.concatenate(client.pre_dp_norms) for client in clients], dtype=np.float32)
+            post_dp_norms = np.stack([client.post_dp_norms for client in clients], dtype=np.float32)
+            noise_norms = np.stack([client.noise_norms for client in clients], dtype=np.float32)
+
+        elif args.dp_mode == 'local_pvi':
+            pre_dp_norms = np.stack([client.pre_dp_norms for client in clients], dtype=np.float32)
+            post_dp_norms = np.zeros((args.clients, args.n_global_updates), dtype=np.float32)
+            #post_dp_norms = np.stack([client.post_dp_norms for client in clients], dtype=np.float32)
+            noise_norms = np.stack([client.noise_norms for client in clients], dtype=np.float32)
+
+        tracked['client_norms'] = {}
+        tracked['client_norms']['pre_dp_norms'] = pre_dp_norms
+        tracked['client_norms']['post_dp_norms'] = post_dp_norms
+        try:
+            tracked['client_norms']['noise_norms'] = noise_norms
+        except:
+            pass
+
+    if args.track_client_norms and args.plot_tracked:
+        # separate script for lfa/dpsgd etc?
+        pre_dp_norms = tracked['client_norms']['pre_dp_norms']
+        post_dp_norms = tracked['client_norms']['post_dp_norms']
+        if args.dp_mode == 'dpsgd':
+            x1 = np.arange(1, args.n_global_updates*args.n_steps+1)
+            x2 = np.arange(1, args.n_global_updates*args.n_steps+1)
         elif args.dp_mode in ['lfa']:
-            pre_dp_norms = np.zeros((args.clients, args.n_global_updates * args.n_steps))
-            post_dp_norms = np.zeros((args.clients, args.n_global_updates))
-            for i_client, client in enumerate(clients):
-                pre_dp_norms[i_client,:] = np.concatenate([norms for norms in client.pre_dp_norms])
-                post_dp_norms[i_client,:] = client.post_dp_norms
-            x1 = np.linspace(1,args.n_global_updates*args.n_steps, args.n_global_updates*args.n_steps)
-            x2 = np.linspace(1,args.n_global_updates, args.n_global_updates)
+            x1 = np.arange(1, args.n_global_updates*args.n_steps+1)
+            x2 = np.arange(1, args.n_global_updates+1)
         elif args.dp_mode in ['local_pvi']:
-            pre_dp_norms = np.zeros((args.clients, args.n_global_updates))
-            post_dp_norms = np.zeros((args.clients, args.n_global_updates))
-            for i_client, client in enumerate(clients):
-                pre_dp_norms[i_client,:] =  client.pre_dp_norms
-                post_dp_norms[i_client,:] = client.post_dp_norms
-            x1 = np.linspace(1,args.n_global_updates, args.n_global_updates)
-            x2 = np.linspace(1,args.n_global_updates, args.n_global_updates)
+            # tracked post DP norms are not filled for local pvi
+            post_dp_norms = np.stack([client.post_dp_norms for client in clients], dtype=np.float32)
+            x1 = np.arange(1, args.n_global_updates+1)
+            x2 = np.arange(1, args.n_global_updates+1)
 
 
         fig,axs = plt.subplots(2,figsize=(10,7))
@@ -364,11 +416,9 @@ def main(args, rng_seed, dataset_folder):
 
         # plot distance from init
         if False:
-            x = np.linspace(1,args.n_global_updates,args.n_global_updates)
-            y = [ np.sqrt( \
-                np.linalg.norm(param_trace1[0,:]-param_trace1[i+1,:],ord=2)**2 \
-                + np.linalg.norm(param_trace2[0,:]-param_trace2[i+1,:],ord=2)**2 ) \
-                for i in range(args.n_global_updates)]
+            x = np.arange(1, args.n_global_updates+1)
+            diff = np.concatenate([param_trace1 - param_trace1[0], param_trace2 - param_trace2[0]], axis=1)
+            y = np.linalg.norm(diff[1:], axis=1)
             fig,axs = plt.subplots(2,figsize=(10,7))
             axs[0].plot(x,y)
             axs[1].plot(x, validation_res['logl'])
@@ -383,7 +433,7 @@ def main(args, rng_seed, dataset_folder):
 
         # model acc + logl plot
         if False:
-            x = np.linspace(1,args.n_global_updates,args.n_global_updates)
+            x = np.arange(1, args.n_global_updates+1)
             fig,axs = plt.subplots(2,figsize=(10,7))
             axs[0].plot(x, validation_res['acc'])
             axs[1].plot(x, validation_res['logl'])
@@ -400,7 +450,7 @@ def main(args, rng_seed, dataset_folder):
 
         # param trace plot over training
         if True:
-            x = np.linspace(0,args.n_global_updates,args.n_global_updates+1)
+            x = np.arange(args.n_global_updates+1)
             fig,axs = plt.subplots(2,figsize=(10,7))
             axs[0].plot(x,param_trace1)
             axs[1].plot(x,param_trace2)
@@ -416,47 +466,6 @@ def main(args, rng_seed, dataset_folder):
             #plt.close()
             plt.show()
 
-    # compile possible tracked norms etc
-    tracked = {}
-    if args.track_client_norms:
-        if args.dp_mode == 'dpsgd':
-            if args.model == 'global_vi':
-                pre_dp_norms = np.zeros((1, args.n_global_updates * args.n_steps))
-                post_dp_norms = np.zeros((1, args.n_global_updates * args.n_steps))
-                pre_dp_norms[0,:] = server.pre_dp_norms
-                post_dp_norms[0,:] = server.post_dp_norms
-            else:
-                pre_dp_norms = np.zeros((args.clients, args.n_global_updates * args.n_steps))
-                post_dp_norms = np.zeros((args.clients, args.n_global_updates * args.n_steps))
-                for i_client, client in enumerate(clients):
-                    pre_dp_norms[i_client,:] = client.pre_dp_norms
-                    post_dp_norms[i_client,:] = client.post_dp_norms
-        elif args.dp_mode in ['lfa']:
-            pre_dp_norms = np.zeros((args.clients, args.n_global_updates * args.n_steps))
-            post_dp_norms = np.zeros((args.clients, args.n_global_updates))
-            noise_norms = np.zeros((args.clients, args.n_global_updates))
-            for i_client, client in enumerate(clients):
-                pre_dp_norms[i_client,:] = np.concatenate([norms for norms in client.pre_dp_norms])
-                post_dp_norms[i_client,:] = client.post_dp_norms
-                noise_norms[i_client,:] = client.noise_norms
-
-        elif args.dp_mode == 'local_pvi':
-            pre_dp_norms = np.zeros((args.clients, args.n_global_updates))
-            post_dp_norms = np.zeros((args.clients, args.n_global_updates))
-            noise_norms = np.zeros((args.clients, args.n_global_updates))
-            for i_client, client in enumerate(clients):
-                pre_dp_norms[i_client,:] = client.pre_dp_norms
-                #post_dp_norms[i_client,:] = client.post_dp_norms
-                noise_norms[i_client,:] = client.noise_norms
-
-        tracked['client_norms'] = {}
-        tracked['client_norms']['pre_dp_norms'] = pre_dp_norms
-        tracked['client_norms']['post_dp_norms'] = post_dp_norms
-        try:
-            tracked['client_norms']['noise_norms'] = noise_norms
-        except:
-            pass
-
     # some tracked norm plotting for local PVI
     if args.track_client_norms and args.plot_tracked:
         fix, axs = plt.subplots(1,3)
@@ -479,6 +488,10 @@ def main(args, rng_seed, dataset_folder):
         #plt.plot(client.noise_norms)
         #plt.show()
 
+    if args.track_client_norms:
+        # only used for plotting/analysis, store in half precision; all math above uses float32
+        tracked['client_norms'] = {k: _to_float16(v, name=k) for k, v in tracked['client_norms'].items()}
+
     return validation_res, train_res, client_train_res, prop_positive, tracked
 
 
@@ -556,6 +569,7 @@ if __name__ == '__main__':
     parser.add_argument('--track_client_norms', default=False, action='store_true', help="Track all (grad) norms pre & post DP (for debugging).")
     parser.add_argument('--plot_tracked', default=False, action='store_true', help="For debugging: plot all tracked stuff after learning.")
     parser.add_argument('--pbar', default=True, action='store_false', help="Disable tqdm progress bars.")
+    parser.add_argument('--jit', default=False, action='store_true', help="Use torch.jit.trace to compile the model predictive function.")
     args = parser.parse_args()
 
     main(args, rng_seed=2303, dataset_folder=args.folder)
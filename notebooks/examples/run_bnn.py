@@ -6,7 +6,6 @@ import argparse
 from copy import deepcopy
 import logging
 import os
-import random
 import sys
 from warnings import warn
 
@@ -14,7 +13,6 @@ import matplotlib.pyplot as plt
 import numpy as np
 import torch
 import tqdm.auto as tqdm
-from sklearn.model_selection import KFold
 
 module_path = os.path.abspath(os.path.join("../.."))
 if module_path not in sys.path:
@@ -104,11 +102,7 @@ def main(args, rng_seed, dataset_folder):
             raise ValueError(f"Unknown dp_mode: {args.dp_mode}")
 
     # fix random seeds
-    np.random.seed(rng_seed)
-    torch.random.manual_seed(rng_seed)
-    random.seed(rng_seed)
-    if torch.cuda.is_available() and torch.cuda.device_count() > 0:
-      torch.cuda.manual_seed(rng_seed)
+    seed_everything(rng_seed)
 
 
     data_args=None
@@ -326,13 +320,15 @@ def main(args, rng_seed, dataset_folder):
         if args.model != 'global_vi':
 
             # get client training curves
+            compiled_log = server.get_compiled_log()
             for i_client in range(args.clients):
 
                 if args.dp_mode not in ['mixed_dpsgd'] and args.n_step_dict is None:
                     # client log shapes may change during run with mixed_dpsgd, so skip these for now
-                    client_train_res['elbo'][i_client,i_global,:] = server.get_compiled_log()[f'client_{i_client}']['training_curves'][server.iterations-1]['elbo']
-                    client_train_res['logl'][i_client,i_global,:] = server.get_compiled_log()[f'client_{i_client}']['training_curves'][server.iterations-1]['ll']
-                    client_train_res['kl'][i_client,i_global,:] = server.get_compiled_log()[f'client_{i_client}']['training_curves'][server.iterations-1]['kl']
+                    curves = compiled_log[f'client_{i_client}']['training_curves'][server.iterations-1]
+                    client_train_res['elbo'][i_client,i_global,:] = curves['elbo']
+                    client_train_res['logl'][i_client,i_global,:] = curves['ll']
+                    client_train_res['kl'][i_client,i_global,:] = curves['kl']
         
 
 
@@ -430,7 +426,7 @@ def main(args, rng_seed, dataset_folder):
         #plt.show()
 
         #sys.exit()
-        x = np.linspace(0,args.n_global_updates,args.n_global_updates+1)
+        x = np.arange(args.n_global_updates+1)
         fig,axs = plt.subplots(2,figsize=(10,7))
         axs[0].plot(x,param_trace1)
         axs[1].plot(x,param_trace2)
@@ -1,12 +1,12 @@
 
+import concurrent.futures
 import logging
 import os
+import random
 import sys
 
 from matplotlib import pyplot as plt
 import numpy as np
-from sklearn.model_selection import KFold
-from sklearn import metrics
 import torch
 import torch.utils.data
 from torchvision import transforms, datasets
@@ -41,6 +41,24 @@ handler.setFormatter(formatter)
 logger.addHandler(handler)
 
 
+def seed_everything(rng_seed):
+    """Fix python, numpy and torch (incl. cuda) random seeds
+    """
+    np.random.seed(rng_seed)
+    torch.random.manual_seed(rng_seed)
+    random.seed(rng_seed)
+    if torch.cuda.is_available() and torch.cuda.device_count() > 0:
+      torch.cuda.manual_seed(rng_seed)
+
+
+def _np2t(arr):
+    """Convert array or tensor to float32 tensor, shares memory instead of copying when already float32
+    """
+    if torch.is_tensor(arr):
+        return arr.float()
+    return torch.from_numpy(np.ascontiguousarray(arr, dtype=np.float32))
+
+
 def set_up_clients(model, client_data, init_nat_params, config, dp_mode, batch_size, sampling_frac_q):
 
     clients = []
@@ -48,7 +66,7 @@ def set_up_clients(model, client_data, init_nat_params, config, dp_mode, batch_s
     # Create clients
     for i,_client_data in enumerate(client_data):
         # Data of ith client
-        data = {k : torch.tensor(v).float() for k, v in _client_data.items()}
+        data = {k : _np2t(v) for k, v in _client_data.items()}
         #logger.debug(f"Client {i} data {data['x'].shape}, {data['y'].shape}")
 
         # Approximating likelihood term of ith client
@@ -128,7 +146,6 @@ def standard_client_split(dataset_seed, num_clients, client_size_factor, class_b
         #    raise ValueError('Need to have proper data_args to generate data when dataset_folder is None!')
 
         logger.info('Generating data')
-        client_data = []
 
         ####################
         # two params, means=(1,2), scale jsut from prior
@@ -147,21 +164,25 @@ def standard_client_split(dataset_seed, num_clients, client_size_factor, class_b
             data_args['coef']['train'].append(torch.tensor([1.,2.])) # y mean included as 0th coef
 
         # generate training and test data for logistic regression
-        for i_client in range(num_clients):
-            client_data.append({})
-            client_data[-1]['x'] = torch.distributions.multivariate_normal.MultivariateNormal(
-                    loc=data_args['mean']['train'][i_client], covariance_matrix=data_args['cov']['train'][i_client]).sample( [data_args['sample_size']['train'][i_client],])
-            
-            tmp = torch.nn.Sigmoid()(torch.matmul(client_data[-1]['x'],data_args['coef']['train'][i_client][1:]) + data_args['coef']['train'][i_client][0] )
-            #print(client_data[-1]['x'].shape,tmp.shape)
-            #print(tmp)
-            client_data[-1]['y'] = torch.bernoulli(tmp)
+        # draw standard normals for all clients at once, then shift & scale separately for each client
+        sizes = data_args['sample_size']['train']
+        x_all = torch.randn(sum(sizes), len(data_args['mean']['train'][0]))
+        for x_client, loc, cov in zip(torch.split(x_all, sizes), data_args['mean']['train'], data_args['cov']['train']):
+            x_client.copy_(_gaussian_from_std_normal(x_client, loc, cov))
+
+        # draw labels for all clients at once, each client coef repeated for all client samples
+        coef = torch.repeat_interleave(torch.stack(data_args['coef']['train']), torch.tensor(sizes), dim=0)
+        logits = torch.sum(x_all * coef[:,1:], dim=-1) + coef[:,0]
+        y_all = torch.bernoulli(torch.sigmoid_(logits))
+
+        # client data are views to the full train data
+        client_data = [{'x': x, 'y': y} for x, y in zip(torch.split(x_all, sizes), torch.split(y_all, sizes))]
         # generate some training and test data for linear regression
-        tmp_x = torch.distributions.multivariate_normal.MultivariateNormal(
-                    loc=data_args['mean']['test'], covariance_matrix=data_args['cov']['test']).sample([data_args['sample_size']['test'],])
+        tmp_x = _gaussian_from_std_normal(torch.randn(data_args['sample_size']['test'], len(data_args['mean']['test'])),
+                    data_args['mean']['test'], data_args['cov']['test'])
         # logistic regression data:
 
-        tmp_y = torch.bernoulli(torch.nn.Sigmoid()(torch.matmul(tmp_x,data_args['coef']['test'][1:]) + data_args['coef']['test'][0] ))
+        tmp_y = torch.bernoulli(torch.sigmoid_(torch.matmul(tmp_x,data_args['coef']['test'][1:]) + data_args['coef']['test'][0] ))
         ####################
         #"""
 
@@ -176,8 +197,8 @@ def standard_client_split(dataset_seed, num_clients, client_size_factor, class_b
                     }
 
         N, prop_positive = data_args['sample_size']['train'], np.zeros(num_clients)
-        train_set = {'x' : torch.tensor(np.concatenate([data_dict['x'] for data_dict in client_data ])).float(),
-                     'y' : torch.tensor(np.concatenate([data_dict['y'] for data_dict in client_data ])).float() }
+        train_set = {'x' : x_all,
+                     'y' : y_all }
 
         del tmp_x, tmp_y
         #print(train_set['x'].shape, valid_set['x'].shape)
@@ -191,17 +212,17 @@ def standard_client_split(dataset_seed, num_clients, client_size_factor, class_b
             logger.info('Using balanced MIMIC-III split')
             filename = dataset_folder+f'mimic_in-hospital_bal_split.npz'
             tmp = np.load(filename)
-            x_train, y_train = tmp['train_X'], tmp['train_y']
+            x_all, y_all = tmp['train_X'], tmp['train_y']
             #print(len(tmp['train_y']),np.sum(tmp['train_y'] == 0), np.sum(tmp['train_y'] == 1)/len(tmp['train_y']))
             del tmp
-            # shuffle data before starting to split
-            inds = np.linspace(0,len(y_train)-1,len(y_train),dtype=int)
-            np.random.shuffle(inds)
-            x_train, y_train = x_train[inds,:], y_train[inds]
+            # shuffle data before starting to split: compose the shuffle with the split inds to gather data only once
+            inds = np.random.permutation(len(y_all))
 
             # note: this uses 4/5 of total data for training, 1/5 as test
-            full_data_split = get_nth_split(n_splits=5, n=k_split, folder=None, x=x_train, y=y_train)
-            x_train, x_valid, y_train, y_valid = full_data_split
+            train_inds, valid_inds = _kfold_inds(len(y_all), n_splits=5, n=k_split)
+            x_train, x_valid = x_all[inds[train_inds]], x_all[inds[valid_inds]]
+            y_train, y_valid = y_all[inds[train_inds]], y_all[inds[valid_inds]]
+            del x_all, y_all
             #print(len(y_train), np.sum(y_train==1))
 
             # Prepare training data held by each client
@@ -212,31 +233,40 @@ def standard_client_split(dataset_seed, num_clients, client_size_factor, class_b
                                                                  class_balance_factor=class_balance_factor,
                                                                  dataset_seed=dataset_seed)
 
-            train_set = {'x' : torch.tensor(x_train).float(),
-                         'y' : torch.tensor(y_train).float()}
+            train_set = {'x' : _np2t(x_train),
+                         'y' : _np2t(y_train)}
             # Validation set, to predict on using global model
-            valid_set = {'x' : torch.tensor(x_valid).float(),
-                         'y' : torch.tensor(y_valid).float()}
+            valid_set = {'x' : _np2t(x_valid),
+                         'y' : _np2t(y_valid)}
 
 
         else:
             logger.info('Using unbalanced MIMIC-III split')
             filename = dataset_folder+f'mimic_in-hospital_unbal_split_{num_clients}clients.npz'
-            tmp = np.load(filename)
-            client_data = []
-            N, prop_positive = np.zeros(num_clients), np.zeros(num_clients)
-            for i_client in range(num_clients):
-                client_data.append({})
-                client_data[-1]['x'] = tmp[f'x_{i_client}']
-                client_data[-1]['y'] = tmp[f'y_{i_client}']
-                N[i_client] = int(len(client_data[-1]['y']))
-                prop_positive[i_client] = np.sum(client_data[-1]['y']==1)/N[i_client]
-
-            train_set = {'x' : torch.tensor(np.concatenate([data_dict['x'] for data_dict in client_data ])).float(),
-                         'y' : torch.tensor(np.concatenate([data_dict['y'] for data_dict in client_data ])).float() }
-            # Validation set, to predict on using global model
-            valid_set = {'x' : torch.tensor(tmp['x_test'], dtype=torch.float),
-                         'y' : torch.tensor(tmp['y_test'], dtype=torch.float)}
+            # npz members are only read on access (mmap_mode does not apply to npz), read each one once
+            with np.load(filename) as tmp:
+                # Validation set, to predict on using global model
+                valid_set = {'x' : _np2t(tmp['x_test']),
+                             'y' : _np2t(tmp['y_test'])}
+
+                # labels are small, read them first to get client sizes
+                y_clients = [tmp[f'y_{i_client}'] for i_client in range(num_clients)]
+                sizes = [len(y_client) for y_client in y_clients]
+                N, prop_positive = np.zeros(num_clients), np.zeros(num_clients)
+                for i_client, y_client in enumerate(y_clients):
+                    N[i_client] = sizes[i_client]
+                    prop_positive[i_client] = np.sum(y_client==1)/N[i_client]
+
+                # copy client inputs one at a time into the full train set, avoids keeping separate client copies
+                x_all = torch.empty((sum(sizes), *valid_set['x'].shape[1:]), dtype=torch.float32)
+                for i_client, x_client in enumerate(torch.split(x_all, sizes)):
+                    x_client.copy_(torch.from_numpy(tmp[f'x_{i_client}']))
+                y_all = _np2t(np.concatenate(y_clients))
+
+            # client data are views to the full train data
+            client_data = [{'x': x, 'y': y} for x, y in zip(torch.split(x_all, sizes), torch.split(y_all, sizes))]
+            train_set = {'x' : x_all,
+                         'y' : y_all}
 
 
     elif 'MNIST' in dataset_folder:
@@ -248,12 +278,12 @@ def standard_client_split(dataset_seed, num_clients, client_size_factor, class_b
         test_set = datasets.MNIST(root=dataset_folder, train=False, download=False, transform=transform_test)
 
         train_set = {
-            "x": ((train_set.data - 0) / 255.).reshape(-1, 28 * 28),
+            "x": _mnist_to_float(train_set.data),
             "y": train_set.targets,
         }
 
         valid_set = {
-            "x": ((test_set.data - 0) / 255.).reshape(-1, 28 * 28),
+            "x": _mnist_to_float(test_set.data),
             "y": test_set.targets,
         }
         logger.debug(f"MNIST shapes, train: {train_set['x'].shape}, {train_set['y'].shape}, test: {valid_set['x'].shape}, {valid_set['y'].shape}")
@@ -279,11 +309,13 @@ def standard_client_split(dataset_seed, num_clients, client_size_factor, class_b
             #for i in range(10):
             #    print(f"{i}: {torch.sum(train_set['y']==i)}")
             
-            sorted_inds = torch.argsort(train_set['y'])
-            shards = np.random.permutation(np.linspace(0,n_shards-1,n_shards))
+            # counting sort over the few label values, gives a stable ordering within each class
+            sorted_inds = torch.cat([(train_set['y'] == k).nonzero(as_tuple=True)[0] for k in range(int(train_set['y'].max())+1)])
+            shards = np.random.permutation(n_shards)
+            shard_offsets = np.arange(shard_len)
             for i_client in range(num_clients):
                 tmp_ind = shards[(2*i_client):(2*i_client+2)]
-                shard_inds = sorted_inds[ np.concatenate([ np.linspace(i*shard_len,(i+1)*shard_len-1,shard_len,dtype=int) for i in tmp_ind]) ]
+                shard_inds = sorted_inds[ np.add.outer(tmp_ind*shard_len, shard_offsets).ravel() ]
                 client_data.append({"x": train_set["x"][shard_inds], "y": train_set["y"][shard_inds]})
                 N[i_client] = len(client_data[-1]['y'])
             #print(len(client_data))
@@ -306,14 +338,28 @@ def standard_client_split(dataset_seed, num_clients, client_size_factor, class_b
                                                              class_balance_factor=class_balance_factor,
                                                              dataset_seed=dataset_seed)
 
-        train_set = {'x' : torch.tensor(x_train).float(),
-                     'y' : torch.tensor(y_train).float()}
+        train_set = {'x' : _np2t(x_train),
+                     'y' : _np2t(y_train)}
         # Validation set, to predict on using global model
-        valid_set = {'x' : torch.tensor(x_valid).float(),
-                     'y' : torch.tensor(y_valid).float()}
+        valid_set = {'x' : _np2t(x_valid),
+                     'y' : _np2t(y_valid)}
 
     return client_data, train_set, valid_set, N, prop_positive
 
+def _mnist_to_float(data):
+    """Convert uint8 MNIST images to flattened float32 in [0,1] with a single pass
+    """
+    return data.to(torch.float32).mul_(1./255.).view(data.size(0), -1)
+
+
+def _gaussian_from_std_normal(z, loc, cov):
+    """Transform standard normal samples z to samples from N(loc, cov), skips Cholesky when cov is identity
+    """
+    if torch.equal(cov, torch.eye(len(loc))):
+        return loc + z
+    return loc + z @ torch.linalg.cholesky(cov).T
+
+
 def cont_acc_and_ll(server, x, y):
     """Calculate model prediction mean sq err with LinearRegression model
     """
@@ -325,23 +371,53 @@ def cont_acc_and_ll(server, x, y):
     return acc, loglik, None
 
 
+def _is_binary(y):
+    """Check if labels (numpy array or tensor) are 0/1 with both classes present, single pass instead of sorting for unique values
+    """
+    is_pos = y == 1
+    return bool((is_pos | (y == 0)).all() and is_pos.any() and not is_pos.all())
+
+
 def acc_and_ll(server, x, y, n_points=101):
     """Calculate model prediction acc & logl with LogisticRegression model
     n_points : (int) number of points to calculate classification results
     """
-    #try:
-    pred_probs = server.model_predict(x)
-    pred_probs = pred_probs.mean.detach().numpy()
-    acc = np.mean((pred_probs > 0.5) == y.numpy())
-    
-    probs = torch.clamp(torch.tensor(pred_probs),min= 0., max=1.)
-    loglik = torch.distributions.Bernoulli(probs=probs).log_prob(y)
-    loglik = loglik.mean().numpy()
+    with torch.no_grad():
+        pred_probs = server.model_predict(x).mean
+
+    return _acc_and_ll_from_probs(pred_probs, y, n_points)
+
+
+def acc_and_ll_multi(server, data, n_points=101):
+    """Calculate model prediction acc & logl with LogisticRegression model on several data sets,
+    using the same posterior samples for all of them
+    data : list of (x, y) tuples
+    n_points : (int) number of points to calculate classification results
+    """
+    with torch.no_grad():
+        # draw weights once and reuse them for each data set instead of concatenating the inputs
+        # (probit approximation is deterministic and uses no samples)
+        thetas = None
+        if not server.model.config['use_probit_approximation']:
+            thetas = server.q.distribution.sample((server.model.config['num_predictive_samples'],))
+        all_probs = [server.model_predict(x, thetas=thetas).mean for x, _ in data]
+
+    return [_acc_and_ll_from_probs(pred_probs, y, n_points) for pred_probs, (_, y) in zip(all_probs, data)]
+
+
+def _acc_and_ll_from_probs(pred_probs, y, n_points):
+    """Calculate acc, logl & classification results from predicted probabilities, all metrics computed in torch
+    """
+    pred_probs = pred_probs.clamp_(min=0., max=1.)
+    acc = ((pred_probs > 0.5).to(y.dtype) == y).float().mean().item()
+    loglik = torch.distributions.Bernoulli(probs=pred_probs).log_prob(y).mean().item()
 
     # get true & false positives and negatives
-    if len(torch.unique(y)) == 2:
+    if _is_binary(y):
+        # get_posneg needs sklearn, import outside try so that a missing sklearn raises instead of giving posneg=None
+        from sklearn import metrics
         try:
-            posneg = get_posneg(y.numpy(), pred_probs, n_points)
+            posneg = get_posneg(y.numpy(), pred_probs.numpy(), n_points, is_binary=True)
         except:
             posneg = None
     else:
@@ -357,23 +433,31 @@ def acc_and_ll_bnn(server, x, y, n_points=101):
     dataset = torch.utils.data.TensorDataset(x, y)
     loader = torch.utils.data.DataLoader(dataset, batch_size=500, shuffle=False)
 
-    preds, mlls = [], []
-    for (x_batch, y_batch) in loader:
-        #x_batch, y_batch = x_batch.to(device), y_batch.to(device)
-
-        pp = server.model_predict(x_batch)
-        preds.append(pp.component_distribution.probs.mean(1).cpu())
-        mlls.append(pp.log_prob(y_batch).cpu())
-
-    mll = torch.cat(mlls).mean()
-    preds = torch.cat(preds)
-    #acc = sum(torch.argmax(preds, dim=-1) == loader.dataset.tensors[1]) / len(loader.dataset.tensors[1])
-    acc = torch.true_divide(sum(torch.argmax(preds, dim=-1) == loader.dataset.tensors[1]), len(loader.dataset.tensors[1]))
+    # write batch results directly to preallocated tensors, preds allocated on first batch when n_classes is known
+    preds, mlls = None, torch.empty(len(dataset))
+    offset = 0
+    # no gradients needed for evaluation, inference mode also skips autograd version tracking
+    with torch.inference_mode():
+        for (x_batch, y_batch) in loader:
+            #x_batch, y_batch = x_batch.to(device), y_batch.to(device)
+
+            pp = server.model_predict(x_batch)
+            batch_probs = pp.component_distribution.probs.mean(1)
+            if preds is None:
+                preds = torch.empty((len(dataset), batch_probs.shape[-1]))
+            preds[offset:offset+len(y_batch)].copy_(batch_probs)
+            mlls[offset:offset+len(y_batch)].copy_(pp.log_prob(y_batch))
+            offset += len(y_batch)
+
+    mll = mlls.mean()
+    acc = (preds.argmax(-1) == y).float().mean()
     
     # get true & false pos. and neg.
-    if len(torch.unique(y)) == 2:
+    if _is_binary(y):
+        # get_posneg needs sklearn, import outside try so that a missing sklearn raises instead of giving posneg=None
+        from sklearn import metrics
         try:
-            posneg = get_posneg(y.numpy(), preds[:,1].numpy(), n_points)
+            posneg = get_posneg(y.numpy(), preds[:,1].numpy(), n_points, is_binary=True)
         except:
             posneg = None
     else:
@@ -382,34 +466,48 @@ def acc_and_ll_bnn(server, x, y, n_points=101):
     return acc, mll, posneg
 
 
-def get_posneg(y, pred_probs, n_points):
+def get_posneg(y, pred_probs, n_points, is_binary=None):
     """Fun for calculating True & False positives and negatives from binary predictions
+    is_binary : (bool) whether y has binary 0/1 labels, checked from y if None
     """
+    # sklearn is slow to import, only load it when actually needed
+    from sklearn import metrics
+
+    if is_binary is None:
+        is_binary = _is_binary(y)
 
     # binary classification
-    if len(np.unique(y)) == 2:
+    if is_binary:
+        # class masks & sizes shared by both branches
+        pos_mask = y == 1
+        neg_mask = ~pos_mask
+        n_pos = np.count_nonzero(pos_mask)
+        n_neg = np.count_nonzero(neg_mask)
         if n_points == 1:
+            pred_pos = pred_probs > 0.5
+            TP = np.count_nonzero(pred_pos & pos_mask)
+            FP = np.count_nonzero(pred_pos & neg_mask)
             posneg = {
-                    'TP' : [np.sum( (pred_probs > 0.5)[y==1] == y[y==1])],
-                    'FP' : [np.sum( (pred_probs > 0.5)[y==0] != y[y==0])],
-                    'TN' : [np.sum( (pred_probs <= 0.5)[y==0] == 1-y[y==0])],
-                    'FN' : [np.sum( (pred_probs <= 0.5)[y==1] != 1-y[y==1])],
+                    'TP' : [TP],
+                    'FP' : [FP],
+                    'TN' : [n_neg - FP],
+                    'FN' : [n_pos - TP],
                     'n_points' : n_points,
                     }
         else:
             tmp = np.linspace(0,1,n_points)
+            # sort predictions for each class once, number of predictions <= thr is then given by searchsorted
+            pos_probs = np.sort(pred_probs[pos_mask])
+            neg_probs = np.sort(pred_probs[neg_mask])
+            FN = np.searchsorted(pos_probs, tmp, side='right')
+            TN = np.searchsorted(neg_probs, tmp, side='right')
             posneg = {
-                    'TP' : np.zeros(n_points, dtype=int),
-                    'FP' : np.zeros(n_points, dtype=int),
-                    'TN' : np.zeros(n_points, dtype=int),
-                    'FN' : np.zeros(n_points, dtype=int),
+                    'TP' : (n_pos - FN).astype(int),
+                    'FP' : (n_neg - TN).astype(int),
+                    'TN' : TN.astype(int),
+                    'FN' : FN.astype(int),
                     'n_points' : n_points,
                     }
-            for i_thr, thr in enumerate(tmp):
-                posneg['TP'][i_thr] =  int(np.sum( (pred_probs > thr)[y==1] == y[y==1]))
-                posneg['FP'][i_thr] =  int(np.sum( (pred_probs > thr)[y==0] != y[y==0]))
-                posneg['TN'][i_thr] =  int(np.sum( (pred_probs <= thr)[y==0] == 1-y[y==0]))
-                posneg['FN'][i_thr] =  int(np.sum( (pred_probs <= thr)[y==1] != 1-y[y==1]))
 
         # add some ready metrics
         posneg['avg_prec_score'] =  metrics.average_precision_score(y_true=y, y_score=pred_probs)
@@ -425,6 +523,23 @@ def get_posneg(y, pred_probs, n_points):
 
 
 
+def _kfold_bounds(n_samples, n_splits, n):
+    """Start & stop of the validation fold for the nth split, matches sklearn KFold(n_splits, shuffle=False)
+    """
+    # first n_samples % n_splits folds get one extra sample
+    fold_size, n_larger = divmod(n_samples, n_splits)
+    start = n*fold_size + min(n, n_larger)
+    stop = start + fold_size + (n < n_larger)
+    return start, stop
+
+
+def _kfold_inds(n_samples, n_splits, n):
+    """Train & validation inds for the nth split, matches sklearn KFold(n_splits, shuffle=False)
+    """
+    start, stop = _kfold_bounds(n_samples, n_splits, n)
+    return np.concatenate([np.arange(start), np.arange(stop, n_samples)]), np.arange(start, stop)
+
+
 def get_nth_split(n_splits, n, folder=None, x=None, y=None):
     """data splitter
     Args:
@@ -436,17 +551,12 @@ def get_nth_split(n_splits, n, folder=None, x=None, y=None):
         x = np.load(folder + 'x.npy')
         y = np.load(folder + 'y.npy')[:, 0]
     
-    # Kfold splitter from sklearn
-    kfold = KFold(n_splits=n_splits, shuffle=False)
-    
-    # Split data to n_splits splits
-    splits = list(kfold.split(x))
-    x_train = x[splits[n][0]]
-    x_valid = x[splits[n][1]]
-
-    splits = list(kfold.split(y))
-    y_train = y[splits[n][0]]
-    y_valid = y[splits[n][1]]
+    # validation fold is a contiguous block since KFold is not shuffled
+    start, stop = _kfold_bounds(len(x), n_splits, n)
+    x_train = np.concatenate([x[:start], x[stop:]])
+    x_valid = x[start:stop]
+    y_train = np.concatenate([y[:start], y[stop:]])
+    y_valid = y[start:stop]
 
     return x_train, x_valid, y_train,  y_valid
 
@@ -489,58 +599,34 @@ def generate_clients_data(x, y, M, client_size_factor, class_balance_factor, dat
             raise ValueError(f'Not enough positive class instances to fill the small clients. Client size factor:{client_size_factor}, class balance factor:{class_balance_factor}')
 
 
-        pos_inds = np.where(y > 0)
-        zero_inds = np.where(y == 0)
+        # work with indices only, gather client data once at the end
+        pos_inds = np.flatnonzero(y > 0)
+        zero_inds = np.flatnonzero(y == 0)
         
-        assert (len(pos_inds[0]) + len(zero_inds[0])) == len(y), "Some indeces missed."
+        assert (len(pos_inds) + len(zero_inds)) == len(y), "Some indeces missed."
 
-        y_pos = y[pos_inds]
-        y_neg = y[zero_inds]
-
-        x_pos = x[pos_inds]
-        x_neg = x[zero_inds]
-
-        client_data = []
+        client_inds = []
 
         # Populate small classes.
         for i in range(int(M/2)):
-            client_x_pos = x_pos[:small_client_positive_class_size]
-            x_pos = x_pos[small_client_positive_class_size:]
-            client_y_pos = y_pos[:small_client_positive_class_size]
-            y_pos = y_pos[small_client_positive_class_size:]
+            client_ind = np.concatenate([pos_inds[:small_client_positive_class_size], zero_inds[:small_client_negative_class_size]])
+            pos_inds = pos_inds[small_client_positive_class_size:]
+            zero_inds = zero_inds[small_client_negative_class_size:]
 
-            client_x_neg = x_neg[:small_client_negative_class_size]
-            x_neg = x_neg[small_client_negative_class_size:]
-            client_y_neg = y_neg[:small_client_negative_class_size]
-            y_neg = y_neg[small_client_negative_class_size:]
-
-            client_x = np.concatenate([client_x_pos, client_x_neg])
-            client_y = np.concatenate([client_y_pos, client_y_neg])
-
-            shuffle_inds = np.random.permutation(client_x.shape[0])
-
-            client_x = client_x[shuffle_inds, :]
-            client_y = client_y[shuffle_inds]
-
-            client_data.append({'x': client_x, 'y': client_y})
+            shuffle_inds = np.random.permutation(client_ind.shape[0])
+            client_inds.append(client_ind[shuffle_inds])
 
         # Recombine remaining data and shuffle.
-        x = np.concatenate([x_pos, x_neg])
-        y = np.concatenate([y_pos, y_neg])
-        shuffle_inds = np.random.permutation(x.shape[0])
-
-        x = x[shuffle_inds]
-        y = y[shuffle_inds]
+        inds = np.concatenate([pos_inds, zero_inds])
+        shuffle_inds = np.random.permutation(inds.shape[0])
+        inds = inds[shuffle_inds]
 
         # Distribute among large clients.
         for i in range(int(M/2)):
-            client_x = x[:big_client_size]
-            client_y = y[:big_client_size]
-
-            x = x[big_client_size:]
-            y = y[big_client_size:]
+            client_inds.append(inds[:big_client_size])
+            inds = inds[big_client_size:]
 
-            client_data.append({'x': client_x, 'y': client_y})
+        client_data = [{'x': x[client_ind], 'y': y[client_ind]} for client_ind in client_inds]
 
         N_is = [data['x'].shape[0] for data in client_data]
         props_positive = [np.mean(data['y'] > 0) for data in client_data]
@@ -553,16 +639,18 @@ def generate_clients_data(x, y, M, client_size_factor, class_balance_factor, dat
 
 
 def bin_search_sigma(target_eps, ncomp, target_delta, q, nx, L, lbound, ubound, tol, max_iters=10):
+    """Binary search for sigma giving target_eps, returns (sigma, eps) or (None, None) if search did not converge
+    """
 
     for i_iter in tqdm(range(max_iters), disable=True):
         cur = (ubound+lbound)/2
 
-        eps = fourier_accountant.get_epsilon_S(target_delta=target_delta, sigma=cur, q=q, ncomp=ncomp, nx=nx,L=L)
+        eps = fourier_accountant.get_epsilon_S(target_delta=target_delta, sigma=cur, q=q, ncomp=ncomp, nx=nx, L=L)
         logger.debug(f'iter {i_iter}, sigma={cur}, eps={eps:.5f}, upper={ubound}, lower={lbound}')
 
         if np.abs(eps - target_eps) <= tol:
             logger.debug(f'found eps={eps:.5f} with sigma={cur:.5f}')
-            return cur
+            return cur, eps
 
         if eps < target_eps:
             ubound = cur
@@ -570,6 +658,22 @@ def bin_search_sigma(target_eps, ncomp, target_delta, q, nx, L, lbound, ubound,
             lbound = cur
  
     logger.info(f'Did not converge! final sigma={cur:.5f} wirh eps={eps:.5f}')
+    return None, None
+
+
+
+def sweep_sigmas(all_eps, ncomp, target_delta, q, nx, L):
+    """Search sigmas for all target eps with given ncomp & q, returns dict of [eps, sigma] pairs
+    """
+    res = {}
+    for target_eps in all_eps:
+        sigma, eps = bin_search_sigma(target_eps, ncomp, target_delta, q, nx, L, lbound=.7, ubound=300., tol=1e-3, max_iters=30)
+        #print(f'eps={eps} with sigma={sigma}')
+        if sigma is not None:
+            res[f"ncomp{ncomp}_q{q}_eps{target_eps}"] = [np.round(eps,4),np.round(sigma,4)]
+        else:
+            res[f"ncomp{ncomp}_q{q}_eps{target_eps}"] = [None, None]
+    return res
 
 
 
@@ -589,19 +693,13 @@ if __name__ == '__main__':
     all_q = [.1]
     all_eps = [2.]
 
-    # run binary seach on all configurations
+    # run binary seach on all configurations, independent (ncomp, q) configurations run in parallel processes
     all_res = {}
-    for i_comp,ncomp in enumerate(all_comps):
-        print(f'Starting ncomp={ncomp}: {i_comp+1}/{len(all_comps)}')
-        for i_q, q in enumerate(all_q):
-            for i_eps,target_eps in enumerate(all_eps):
-                sigma = bin_search_sigma(target_eps, ncomp, target_delta, q, nx, L, lbound=.7, ubound=300., tol=1e-3, max_iters=30)
-                if sigma is not None:
-                    eps = fourier_accountant.get_epsilon_S(target_delta=1e-5, sigma=sigma, q=q, ncomp=ncomp, nx=nx,L=L)
-                else:
-                    eps = None
-                    #print(f'eps={eps} with sigma={sigma}')
-                all_res[f"ncomp{ncomp}_q{q}_eps{target_eps}"] = [np.round(eps,4),np.round(sigma,4)]
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        futures = {executor.submit(sweep_sigmas, all_eps, ncomp, target_delta, q, nx, L) : (ncomp, q) for ncomp in all_comps for q in all_q}
+        for i_config, future in enumerate(concurrent.futures.as_completed(futures)):
+            all_res.update(future.result())
+            print(f'Finished ncomp={futures[future][0]}, q={futures[future][1]}: {i_config+1}/{len(futures)}')
 
     # print results
     for i_comp,ncomp in enumerate(all_comps):
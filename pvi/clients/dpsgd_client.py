@@ -5,7 +5,6 @@ import sys
 
 from abc import ABC
 from collections import defaultdict
-from torch.utils.data import TensorDataset, DataLoader
 from tqdm.auto import tqdm
 
 from .base import Client
@@ -50,6 +49,10 @@ class DPSGD_Client(Client):
 
         super().__init__(data, model,t=t, config=config)
 
+        if self._config['track_client_norms']:
+            self.pre_dp_norms = []
+            self.post_dp_norms = []
+
 
     def gradient_based_update(self, p, init_q=None, global_prior=None):
         # Cannot update during optimisation.
@@ -118,15 +121,12 @@ class DPSGD_Client(Client):
         x = self.data["x"]
         y = self.data["y"]
 
-        tensor_dataset = TensorDataset(x, y)
-
-        # set up data loader with chosen sampling type
-        # regular SWOR sampler
+        # set up batch sampling with chosen sampling type
+        # regular SWOR sampler: split a fresh permutation into batches on each pass through the data,
+        # index data tensors directly instead of collating single samples with a DataLoader
         if self.config['dp_mode'] == 'dpsgd':
             #logger.debug('setting sampler for dpsgd')
-            sampler = torch.utils.data.BatchSampler(torch.utils.data.RandomSampler(tensor_dataset, replacement=False), batch_size=batch_size, drop_last=False)
-        
-            loader = DataLoader(tensor_dataset, batch_sampler=sampler)
+            batch_inds = iter(())
         else:
             raise ValueError(f"Unexpected dp_mode in base client: {self.config['dp_mode']}")
 
@@ -153,16 +153,13 @@ class DPSGD_Client(Client):
             }
             
             # Loop over batches in current epoch
-            tmp = iter(loader)
-
             for i_step in range(n_samples):
                 try:
-                    #(x_batch, y_batch) = tmp.next() # fix to work with updated pytorch
-                    (x_batch, y_batch) = next(tmp)
+                    inds = next(batch_inds)
                 except StopIteration as err:
-                    tmp = iter(loader)
-                    #(x_batch, y_batch) = tmp.next() # fix to work with updated pytorch
-                    (x_batch, y_batch) = next(tmp)
+                    batch_inds = iter(torch.randperm(len(y)).split(batch_size))
+                    inds = next(batch_inds)
+                x_batch, y_batch = x[inds], y[inds]
 
                 #logger.debug(f'optimiser starting step {i_step} with total batch_size {len(y_batch)}')
 
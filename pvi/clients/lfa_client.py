@@ -53,6 +53,12 @@ class LFA_Client(Client):
             self.n_local_models = int(np.floor((self.data['y'].shape[-1])/config['batch_size']))
         self.optimiser_states = None
         self.lr_scheduler_states = None
+
+        # actually tracks norm of change in params for LFA
+        if self._config['track_client_norms']:
+            self.pre_dp_norms = []
+            self.post_dp_norms = []
+            self.noise_norms = []
         
 
     def gradient_based_update(self, p, init_q=None, global_prior=None):
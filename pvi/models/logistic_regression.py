@@ -21,6 +21,10 @@ class LogisticRegressionModel(Model, nn.Module):
         Model.__init__(self, **kwargs)
         nn.Module.__init__(self)
 
+        # Maps (x, sampled θ) to predictive logits, can be replaced by a
+        # traced version of itself (see torch.jit.trace).
+        self._predict_fn = self.predictive_logits
+
     def get_default_nat_params(self):
         if self.include_bias:
             return {
@@ -43,12 +47,14 @@ class LogisticRegressionModel(Model, nn.Module):
         """
         return {}
 
-    def forward(self, x, q, **kwargs):
+    def forward(self, x, q, thetas=None, **kwargs):
         """
         Returns the (approximate) predictive posterior distribution of a
         Bayesian logistic regression model.
         :param x: The input locations to make predictions at.
         :param q: The approximate posterior distribution q(θ).
+        :param thetas: Optional samples θ_m ~ q(θ) of shape (M, D + 1), drawn
+        from q if not given. Ignored with the probit approximation.
         :return: ∫ p(y | θ, x) q(θ) dθ ≅ (1/M) Σ_m p(y | θ_m, x) θ_m ~ q(θ).
         """
         if self.config["use_probit_approximation"]:
@@ -75,15 +81,29 @@ class LogisticRegressionModel(Model, nn.Module):
             return distributions.Bernoulli(logits=logits)
 
         else:
-            thetas = q.distribution.sample(
-                (self.config["num_predictive_samples"],))
+            if thetas is None:
+                thetas = q.distribution.sample(
+                    (self.config["num_predictive_samples"],))
 
-            comp_ = self.likelihood_forward(x, thetas)
-            comp = distributions.Bernoulli(logits=comp_.logits.T)
+            comp = distributions.Bernoulli(logits=self._predict_fn(x, thetas))
             mix = distributions.Categorical(torch.ones(len(thetas),))
 
             return distributions.MixtureSameFamily(mix, comp)
 
+    def predictive_logits(self, x, thetas):
+        """
+        Returns the logits of p(y | θ_m, x) for each sampled θ_m.
+        :param x: Input of shape (N, D).
+        :param thetas: Sampled parameters of shape (M, D + 1).
+        :return: Logits of shape (N, M).
+        """
+        if self.include_bias:
+            x_ = nn.functional.pad(x, (0, 1), value=1.)
+        else:
+            x_ = x
+
+        return x_.matmul(thetas.T)
+
     def likelihood_forward(self, x, theta, **kwargs):
         """
         Returns the model's likelihood p(y | θ, x).